@@ -1,11 +1,15 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2 import service_account
 from datetime import datetime
 import plotly.express as px
 from io import BytesIO
 import base64
+import hashlib
+import json
+import time
 
 st.set_page_config(page_title="📑 Invoice CRM Dashboard", layout="wide")
 
@@ -13,77 +17,168 @@ st.sidebar.title("🔐 Upload Google Auth JSON")
 json_file = st.sidebar.file_uploader("Upload service_account.json", type="json")
 
 GOOGLE_SHEET_ID = "11ryUchUIGvsnW6cVsuI1rXYAk06xP3dZWcbQ8vyLFN4"
+SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 VISIBLE_COLUMNS = [
     "Customer name", "Customer email", "Product", "Product Description",
     "Price", "Invoice Link", "Status", "Date Created"
 ]
+DISPLAY_COLUMNS = VISIBLE_COLUMNS + ["Invoice Age (Days)"]
+
+
+@st.cache_resource(show_spinner=False)
+def open_workbook(creds_bytes, sheet_id):
+    info = json.loads(creds_bytes)
+    creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+    client = gspread.authorize(creds)
+    return client.open_by_key(sheet_id)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_sheet(sheet_id, tab, creds_hash, _workbook):
+    # creds_hash keys the cache per uploaded credential file; _workbook is not hashed
+    values = _workbook.get_worksheet(tab).get_all_values()
+    if not values:
+        return pd.DataFrame()
+    df = pd.DataFrame(values[1:], columns=[c.strip() for c in values[0]])
+    if not set(VISIBLE_COLUMNS).issubset(df.columns):
+        return df  # caller reports the missing columns
+    df = df[VISIBLE_COLUMNS]
+    # get_all_values() returns display-formatted cells such as "$1,200.00"
+    raw_prices = df["Price"].str.strip()
+    df["Price"] = pd.to_numeric(raw_prices.str.replace(r"[$€£¥,\s]", "", regex=True), errors="coerce")
+    df.attrs["unparsed_prices"] = int((df["Price"].isna() & raw_prices.ne("")).sum())
+    df["Status"] = df["Status"].astype("category")
+    df["Product"] = df["Product"].astype("category")
+    raw_dates = df["Date Created"]
+    dates = pd.to_datetime(raw_dates, errors="coerce", format="ISO8601", cache=True)
+    unparsed = dates.isna() & raw_dates.str.strip().ne("")
+    if unparsed.any():
+        # sheet display formats such as "1/15/2024" or "Jan 15, 2024" fall back to dateutil
+        dates[unparsed] = pd.to_datetime(raw_dates[unparsed], errors="coerce", format="mixed")
+    df["Date Created"] = dates
+    # day-precision numpy subtraction; nullable Int64 keeps unparsed dates as <NA>
+    today = np.datetime64(datetime.today().date(), "D")
+    created = df["Date Created"].values.astype("datetime64[D]")
+    df["Invoice Age (Days)"] = pd.array((today - created) / np.timedelta64(1, "D"), dtype="Int64")
+    df["_name_lc"] = df["Customer name"].str.lower()
+    df["_email_lc"] = df["Customer email"].str.lower()
+    df.attrs["loaded_at"] = time.time()  # identifies this load for caches derived from it
+    return df
+
+
+@st.cache_data(ttl=300, max_entries=16, show_spinner=False)
+def csv_bytes(creds_hash, loaded_at, status_filter, product_filter, search_text, _df):
+    # keyed on the filter state rather than hashing the frame; _df is not hashed
+    buffer = BytesIO()
+    _df.to_csv(buffer, index=False, encoding="utf-8")
+    return buffer.getvalue()
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def build_month_chart(summary):
+    return px.bar(summary, x="Month", y="Price", title="Revenue by Month")
+
+
+def render_new_invoice_form(sheet):
+    with st.expander("➕ Add New Invoice"):
+        with st.form("new_invoice"):
+            new_name = st.text_input("Customer Name")
+            new_email = st.text_input("Customer Email")
+            new_product = st.text_input("Product")
+            new_desc = st.text_area("Product Description")
+            new_price = st.number_input("Price", min_value=0.0)
+            new_link = st.text_input("Invoice Link")
+            new_status = st.selectbox("Status", ["Pending", "Paid", "Overdue"])
+            new_date = st.date_input("Date Created", datetime.today())
+            submitted = st.form_submit_button("Append to Sheet")
+            if submitted:
+                sheet.append_row([
+                    new_name, new_email, new_product, new_desc,
+                    new_price, new_link, new_status, str(new_date)
+                ])
+                load_sheet.clear()
+                csv_bytes.clear()
+                st.success("✅ New invoice added!")
+
 
 if json_file:
     try:
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            eval(json_file.read()), scopes=["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-        )
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(GOOGLE_SHEET_ID).sheet1
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
+        creds_bytes = json_file.getvalue()
+        creds_hash = hashlib.sha256(creds_bytes).hexdigest()
+        workbook = open_workbook(creds_bytes, GOOGLE_SHEET_ID)
+        sheet = workbook.sheet1
+        df = load_sheet(GOOGLE_SHEET_ID, 0, creds_hash, workbook)
 
-        df.columns = df.columns.str.strip()
         missing = [col for col in VISIBLE_COLUMNS if col not in df.columns]
         if missing:
             st.error(f"❌ Missing columns: {missing}")
             st.stop()
 
-        df = df[VISIBLE_COLUMNS]
-        df["Date Created"] = pd.to_datetime(df["Date Created"], errors='coerce')
-        df["Invoice Age (Days)"] = (datetime.today() - df["Date Created"]).dt.days
-
         st.title("📊 Invoice CRM Dashboard")
+        unparsed_prices = df.attrs.get("unparsed_prices", 0)
+        if unparsed_prices:
+            st.warning(f"⚠️ {unparsed_prices} Price value(s) could not be read as numbers and are left out of totals.")
 
         # Filters
+        status_opts = list(df["Status"].cat.categories)
+        product_opts = list(df["Product"].cat.categories)
         with st.expander("🔍 Filters", expanded=False):
-            status_filter = st.multiselect("Filter by Status", df["Status"].unique(), default=list(df["Status"].unique()))
-            product_filter = st.multiselect("Filter by Product", df["Product"].unique(), default=list(df["Product"].unique()))
+            status_filter = st.multiselect("Filter by Status", status_opts, default=status_opts)
+            product_filter = st.multiselect("Filter by Product", product_opts, default=product_opts)
             search_text = st.text_input("Search Customer name/email").lower()
 
-        filtered_df = df[df["Status"].isin(status_filter) & df["Product"].isin(product_filter)]
+        mask = df["Status"].isin(set(status_filter)) & df["Product"].isin(set(product_filter))
         if search_text:
-            filtered_df = filtered_df[
-                filtered_df["Customer name"].str.lower().str.contains(search_text) |
-                filtered_df["Customer email"].str.lower().str.contains(search_text)
-            ]
+            mask &= (
+                df["_name_lc"].str.contains(search_text, regex=False, na=False) |
+                df["_email_lc"].str.contains(search_text, regex=False, na=False)
+            )
+        filtered_df = df.loc[mask]
+        if filtered_df.empty:
+            st.info("No invoices match the current filters.")
+            render_new_invoice_form(sheet)
+            st.stop()
 
         # Metrics
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("Total Invoices", len(filtered_df))
         col2.metric("Total Revenue", f"${filtered_df['Price'].sum():,.2f}")
         col3.metric("Avg Invoice Age", f"{filtered_df['Invoice Age (Days)'].mean():.1f} days")
-        col4.metric("Unpaid Invoices", len(filtered_df[filtered_df["Status"] != "Paid"]))
+        status_counts = filtered_df["Status"].value_counts()
+        col4.metric("Unpaid Invoices", len(filtered_df) - status_counts.get("Paid", 0))
 
         # Invoice Age Groups
-        overdue_30 = filtered_df[filtered_df["Invoice Age (Days)"] > 30]
-        overdue_21 = filtered_df[(filtered_df["Invoice Age (Days)"] > 21) & (filtered_df["Invoice Age (Days)"] <= 30)]
-        overdue_7 = filtered_df[(filtered_df["Invoice Age (Days)"] > 7) & (filtered_df["Invoice Age (Days)"] <= 21)]
+        age_buckets = pd.cut(
+            filtered_df["Invoice Age (Days)"], bins=[-float("inf"), 7, 21, 30, float("inf")],
+            labels=["0-7", "8-21", "22-30", "30+"]
+        )
+        age_counts = age_buckets.value_counts()
 
         with st.expander("📅 Invoice Aging Notifications", expanded=False):
-            st.warning(f"Over 30 days: {len(overdue_30)}")
-            st.info(f"21–30 days: {len(overdue_21)}")
-            st.info(f"7–21 days: {len(overdue_7)}")
+            st.warning(f"Over 30 days: {age_counts['30+']}")
+            st.info(f"21–30 days: {age_counts['22-30']}")
+            st.info(f"7–21 days: {age_counts['8-21']}")
 
         # Charts
-        if not filtered_df.empty:
-            monthly_sales = filtered_df.copy()
-            monthly_sales["Month"] = monthly_sales["Date Created"].dt.to_period("M").astype(str)
-            sales_summary = monthly_sales.groupby("Month")["Price"].sum().reset_index()
-            st.subheader("📈 Monthly Sales")
-            st.plotly_chart(px.bar(sales_summary, x="Month", y="Price", title="Revenue by Month"), use_container_width=True)
-
-        # Table
+        # group on integer month keys, format back to "YYYY-MM" only for the summary rows
+        months = filtered_df["Date Created"].values.astype("datetime64[M]").astype("int64")
+        monthly_totals = filtered_df["Price"].groupby(months, sort=True).sum()
+        sales_summary = pd.DataFrame({
+            "Month": monthly_totals.index.values.astype("datetime64[M]").astype(str),
+            "Price": monthly_totals.values,
+        })
+        st.subheader("📈 Monthly Sales")
+        st.plotly_chart(build_month_chart(sales_summary), use_container_width=True)
+
+        # Table (without the lowercase search helper columns)
+        display_df = filtered_df[DISPLAY_COLUMNS]
         st.subheader("📄 Invoice Table")
-        st.dataframe(filtered_df, use_container_width=True)
+        st.dataframe(display_df, use_container_width=True)
 
         # Download CSV
-        csv = filtered_df.to_csv(index=False).encode('utf-8')
+        csv = csv_bytes(
+            creds_hash, df.attrs.get("loaded_at"), tuple(status_filter), tuple(product_filter), search_text, display_df
+        )
         st.download_button("⬇️ Download CSV", csv, "invoices.csv", "text/csv")
 
         # PDF Export (Optional Demo)
@@ -96,8 +191,13 @@ if json_file:
             c.setFont("Helvetica", 10)
             c.drawString(30, 750, "Invoice Summary Export")
             y = 730
-            for _, row in df.iterrows():
-                text = f"{row['Customer name']} - {row['Product']} - ${row['Price']} - {row['Status']}"
+            # map(str) over object values so missing cells render as "nan" text, as the f-string did
+            text_cols = df[["Customer name", "Product", "Price", "Status"]].astype(object)
+            lines = (
+                text_cols["Customer name"].map(str) + " - " + text_cols["Product"].map(str) +
+                " - $" + text_cols["Price"].map(str) + " - " + text_cols["Status"].map(str)
+            ).tolist()
+            for text in lines:
                 c.drawString(30, y, text)
                 y -= 15
                 if y < 50:
@@ -111,29 +211,16 @@ if json_file:
         st.download_button("⬇️ Export PDF", pdf_file, "invoices.pdf", "application/pdf")
 
         # Add/Edit New Invoice
-        with st.expander("➕ Add New Invoice"):
-            with st.form("new_invoice"):
-                new_name = st.text_input("Customer Name")
-                new_email = st.text_input("Customer Email")
-                new_product = st.text_input("Product")
-                new_desc = st.text_area("Product Description")
-                new_price = st.number_input("Price", min_value=0.0)
-                new_link = st.text_input("Invoice Link")
-                new_status = st.selectbox("Status", ["Pending", "Paid", "Overdue"])
-                new_date = st.date_input("Date Created", datetime.today())
-                submitted = st.form_submit_button("Append to Sheet")
-                if submitted:
-                    sheet.append_row([
-                        new_name, new_email, new_product, new_desc,
-                        new_price, new_link, new_status, str(new_date)
-                    ])
-                    st.success("✅ New invoice added!")
+        render_new_invoice_form(sheet)
 
         # Send/Resend (Demo Only — replace with real SMTP or SendGrid logic)
         with st.expander("✉️ Send or Resend Email"):
-            for i, row in filtered_df.iterrows():
-                if st.button(f"Send to {row['Customer email']}", key=f"send_{i}"):
-                    st.success(f"📬 Email sent to {row['Customer email']} (simulate)")
+            selected_idx = st.selectbox(
+                "Recipient", filtered_df.index,
+                format_func=lambda i: f"{filtered_df.at[i, 'Customer name']} <{filtered_df.at[i, 'Customer email']}>"
+            )
+            if selected_idx is not None and st.button("Send Email"):
+                st.success(f"📬 Email sent to {filtered_df.at[selected_idx, 'Customer email']} (simulate)")
 
     except Exception as e:
         st.error(f"❌ Failed to load data: {e}")